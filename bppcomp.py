@@ -1,13 +1,37 @@
+import ast
+import functools
+import json
+import logging
 import os
 import re
-from typing import Dict, Set, List, Callable, Any
+import sys
+import types
+from typing import Dict, Set, List, Tuple, Callable, Any
 from dataclasses import dataclass
 
+# Shared empty args mapping so argless includes don't allocate one each
+_EMPTY_ARGS = types.MappingProxyType({})
+
+log = logging.getLogger(__name__)
+
 class CircularReferenceError(Exception):
     """Raised when a circular file reference is detected."""
     pass
 
-@dataclass
+@functools.lru_cache(maxsize=1024)
+def _compile_expr(expr: str):
+    """Compile a python_eval expression once per unique source string."""
+    return compile(expr, '<python_eval>', 'eval')
+
+@functools.lru_cache(maxsize=256)
+def _parse_arg_dict(raw: str):
+    """Parse a directive argument dict from JSON or a Python literal."""
+    try:
+        return json.loads(raw)
+    except json.JSONDecodeError:
+        return ast.literal_eval(raw)
+
+@dataclass(slots=True, frozen=True)
 class DirectiveMatch:
     """Represents a matched directive in the text."""
     full_match: str
@@ -17,11 +41,24 @@ class DirectiveMatch:
     end: int
 
 class FileProcessor:
+    # Matches [$directive arg1 arg2 ...] with optional {...} brace arguments
+    _DIRECTIVE_RE = re.compile(r'\[\$([\w_]+)((?:\s+(?:\{.*?\}|[^\]\s]+))*)\]')
+    # Splits a brace-free argument string into bare-word tokens
+    _ARG_RE = re.compile(r'\S+')
+    # Directives whose output is plain text and never needs re-scanning
+    _LITERAL_DIRECTIVES = frozenset({'arg', 'python_eval'})
+
     def __init__(self):
         self.processed_files: Set[str] = set()
         self.current_path: List[str] = []
+        self._current_path_set: Set[str] = set()
         self.MAX_SIZE = 60000
         self.directives: Dict[str, Callable] = {}
+        self._file_cache: Dict[str, str] = {}
+        self._expand_cache: Dict[Tuple[str, Tuple], str] = {}
+        # Bumped whenever an include error is swallowed into a placeholder,
+        # so callers can tell an expansion embedded one
+        self._include_error_count = 0
         
         # Register built-in directives
         self.register_directive('file', self._handle_file)
@@ -32,55 +69,58 @@ class FileProcessor:
 
     def register_directive(self, name: str, handler: Callable):
         """Register a new directive handler."""
-        self.directives[name] = handler
+        self.directives[sys.intern(name)] = handler
+
+    def invalidate_cache(self):
+        """Drop cached file contents, e.g. after files change on disk."""
+        self._file_cache.clear()
+        self._expand_cache.clear()
 
     def read_file_content(self, filename: str) -> str:
-        """Read and return the contents of a file."""
+        """Read and return the contents of a file, caching by real path."""
+        cache_key = os.path.realpath(filename)
+        cached = self._file_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         try:
-            with open(filename, 'r') as file:
-                content = file.read()
-                return content
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                # Read the whole file in one go sized from st_size, then
+                # drain any remainder in case the size was stale.
+                size = os.fstat(fd).st_size
+                chunks = [os.read(fd, size)] if size else []
+                while True:
+                    chunk = os.read(fd, 1 << 16)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            finally:
+                os.close(fd)
+            content = b''.join(chunks).decode('utf-8')
+            self._file_cache[cache_key] = content
+            return content
         except FileNotFoundError:
-            print(f"Warning: File {filename} not found. Keeping original placeholder.")
+            log.warning("File %s not found. Keeping original placeholder.", filename)
             return f"[$file {filename}]"
         except Exception as e:
-            print(f"Error reading file {filename}: {str(e)}")
+            log.error("Error reading file %s: %s", filename, e)
             return f"[$file {filename}]"
 
-    def parse_directive(self, content: str) -> DirectiveMatch | None:
-        """Parse the next directive in the content."""
-        pattern = r'\[\$([\w_]+)((?:\s+(?:\{.*?\}|[^\]\s]+))*)\]'
-        match = re.search(pattern, content)
-        
+    def parse_directive(self, content: str, pos: int = 0) -> DirectiveMatch | None:
+        """Parse the next directive in the content, starting at pos."""
+        match = self._DIRECTIVE_RE.search(content, pos)
+
         if not match:
             return None
-            
-        directive_name = match.group(1)
+
+        # Interned names make the dispatch dict probe a pointer comparison
+        directive_name = sys.intern(match.group(1))
         args_str = match.group(2).strip()
-        
+
         # Parse arguments, handling both JSON-style and space-separated
-        args = []
-        if args_str:
-            current_arg = ''
-            in_braces = False
-            
-            for char in args_str:
-                if char == '{':
-                    in_braces = True
-                    current_arg += char
-                elif char == '}':
-                    in_braces = False
-                    current_arg += char
-                elif char.isspace() and not in_braces:
-                    if current_arg:
-                        args.append(current_arg)
-                        current_arg = ''
-                else:
-                    current_arg += char
-                    
-            if current_arg:
-                args.append(current_arg)
-        
+        args = self._tokenize_args(args_str) if args_str else []
+
         return DirectiveMatch(
             full_match=match.group(0),
             directive_name=directive_name,
@@ -89,13 +129,49 @@ class FileProcessor:
             end=match.end()
         )
 
+    @classmethod
+    def _tokenize_args(cls, args_str: str) -> List[str]:
+        """Split an argument string into whitespace-separated tokens.
+
+        A ``{`` anywhere in a token opens a brace group: whitespace inside
+        balanced braces does not end the token, and nested braces are
+        tracked by depth. Braces are otherwise ordinary token characters,
+        so words like ``a{b}c`` stay whole.
+        """
+        if '{' not in args_str:
+            return cls._ARG_RE.findall(args_str)
+
+        args: List[str] = []
+        length = len(args_str)
+        i = 0
+
+        while i < length:
+            if args_str[i].isspace():
+                i += 1
+                continue
+            start = i
+            depth = 0
+            while i < length:
+                char = args_str[i]
+                if char == '{':
+                    depth += 1
+                elif char == '}':
+                    if depth:
+                        depth -= 1
+                elif depth == 0 and char.isspace():
+                    break
+                i += 1
+            args.append(args_str[start:i])
+
+        return args
+
     def _handle_generate_recursive(self, args: List[str], context: Dict[str, Any]) -> str:
         """Handle recursive pattern generation based on level."""
         if len(args) < 3:
             return "[$generate_recursive missing_arguments]"
             
         try:
-            level = int(context.get('args', {}).get(args[0], '0'))
+            level = int(context['args'].get(args[0], '0'))
             pattern_type = args[1]
             var_name = args[2]
             operation = args[3]
@@ -107,20 +183,20 @@ class FileProcessor:
                 
             return result
         except Exception as e:
-            print(f"Error generating recursive pattern: {str(e)}")
+            log.error("Error generating recursive pattern: %s", e)
             return f"[$generate_recursive {' '.join(args)}]"
 
     def _generate_repeated_math_pattern(self, level: int, var_name: str, operation: str) -> str:
         """Generate nested math pattern up to specified level."""
         if level == 0:
             return f"[VAR {var_name}0]"
-            
-        def build_pattern(n: int) -> str:
-            if n == 0:
-                return f"[VAR {var_name}0]"
-            return f"[MATH [VAR {var_name}{n}] {operation} {build_pattern(n-1)}]"
-            
-        return build_pattern(level)
+
+        # The nesting is a pure left fold: all the opening [MATH ...] parts,
+        # the innermost [VAR ...], then one closing bracket per level.
+        prefix = ''.join(
+            f"[MATH [VAR {var_name}{n}] {operation} " for n in range(level, 0, -1)
+        )
+        return prefix + f"[VAR {var_name}0]" + "]" * level
 
     def _handle_file(self, args: List[str], context: Dict[str, Any]) -> str:
         """Handle file inclusion directive."""
@@ -133,17 +209,18 @@ class FileProcessor:
         # If there's a second argument, treat it as a JSON dictionary of arguments
         if len(args) > 1:
             try:
-                file_args = eval(args[1])
+                file_args = _parse_arg_dict(args[1])
                 if not isinstance(file_args, dict):
-                    print(f"Warning: Arguments for {filename} must be a dictionary")
+                    log.warning("Arguments for %s must be a dictionary", filename)
                     file_args = None
             except Exception as e:
-                print(f"Warning: Failed to parse arguments for {filename}: {str(e)}")
-        
+                log.warning("Failed to parse arguments for %s: %s", filename, e)
+
         try:
-            return self.process_file_recursive(filename, file_args, context.get('depth', 0))
+            return self.process_file_recursive(filename, file_args, context['depth'])
         except (CircularReferenceError, RecursionError) as e:
-            print(f"Error processing {filename}: {str(e)}")
+            log.error("Error processing %s: %s", filename, e)
+            self._include_error_count += 1
             return f"[# $file {filename}: infinite loop]"
 
     def _handle_fileif(self, args: List[str], context: Dict[str, Any]) -> str:
@@ -154,26 +231,29 @@ class FileProcessor:
         filename = args[0]
         check = args[1]
         file_args = None
-        
-        print(check, context.get('args', {}), context.get('args', {}).get(check, False))
-        
-        if not context.get('args', {}).get(check, False):
+        args_dict = context['args']
+
+        enabled = args_dict.get(check, False)
+        log.debug("fileif %s: %s -> %s", check, args_dict, enabled)
+
+        if not enabled:
             return ""
         
         # If there's a third argument, treat it as a JSON dictionary of arguments
         if len(args) > 2:
             try:
-                file_args = eval(args[2])
+                file_args = _parse_arg_dict(args[2])
                 if not isinstance(file_args, dict):
-                    print(f"Warning: Arguments for {filename} must be a dictionary")
+                    log.warning("Arguments for %s must be a dictionary", filename)
                     file_args = None
             except Exception as e:
-                print(f"Warning: Failed to parse arguments for {filename}: {str(e)}")
-        
+                log.warning("Failed to parse arguments for %s: %s", filename, e)
+
         try:
-            return self.process_file_recursive(filename, file_args, context.get('depth', 0))
+            return self.process_file_recursive(filename, file_args, context['depth'])
         except (CircularReferenceError, RecursionError) as e:
-            print(f"Error processing {filename}: {str(e)}")
+            log.error("Error processing %s: %s", filename, e)
+            self._include_error_count += 1
             return f"[# $file {filename}]"
 
     def _handle_arg(self, args: List[str], context: Dict[str, Any]) -> str:
@@ -181,8 +261,8 @@ class FileProcessor:
         if not args:
             return "[# $arg missing_name]"
         
-        arg_name = args[0]
-        return context.get('args', {}).get(arg_name, f"[# $arg {arg_name}]")
+        arg_name = sys.intern(args[0])
+        return context['args'].get(arg_name, f"[# $arg {arg_name}]")
 
     def _handle_python_eval(self, args: List[str], context: Dict[str, Any]) -> str:
         """Handle Python evaluation directive."""
@@ -191,66 +271,151 @@ class FileProcessor:
         
         expression = ' '.join(args)
         try:
-            result = eval(expression)
+            # Cached compile, and empty globals keep the module namespace
+            # (and builtins) out of template expressions
+            result = eval(_compile_expr(expression), {"__builtins__": {}}, {})
             return str(result)
         except Exception as e:
-            print(f"Error evaluating Python expression: {str(e)}")
+            log.error("Error evaluating Python expression: %s", e)
             return f"[# $python_eval {expression}]"
 
     def process_file_recursive(self, filename: str, args: Dict[str, str] = None, depth: int = 0) -> str:
         """Process file inclusions recursively with cycle detection."""
         if depth > 100:  # Prevent excessive recursion
             raise RecursionError("Maximum recursion depth exceeded")
-            
-        if filename in self.current_path:
+
+        # Re-including the same file with the same args yields the same
+        # output, so reuse the previously expanded body when we have one.
+        # Freeze args so the same mapping can be passed down and cached
+        # without risk of a handler mutating it along the way.
+        if args is None:
+            args = _EMPTY_ARGS
+        elif not isinstance(args, types.MappingProxyType):
+            args = types.MappingProxyType(args)
+
+        real_filename = os.path.realpath(filename)
+        try:
+            cache_key = (real_filename, tuple(sorted(args.items())))
+            cached = self._expand_cache.get(cache_key)
+        except TypeError:
+            # Arg values can be unhashable (JSON lists/dicts); process
+            # such includes without memoization.
+            cache_key = None
+            cached = None
+        if cached is not None:
+            return cached
+
+        # The set mirrors current_path for O(1) membership; real paths also
+        # catch cycles routed through symlinks or differing relative paths.
+        if real_filename in self._current_path_set:
             raise CircularReferenceError(
                 f"Circular reference detected: {' -> '.join(self.current_path + [filename])}"
             )
-            
+
         self.current_path.append(filename)
+        self._current_path_set.add(real_filename)
         content = self.read_file_content(filename)
-        
+
+        # Pure-text fragments are common; skip directive processing entirely
+        if '[$' not in content:
+            self.current_path.pop()
+            self._current_path_set.discard(real_filename)
+            if cache_key is not None:
+                self._expand_cache[cache_key] = content
+            return content
+
         # Process all directives
         context = {
             'depth': depth + 1,
-            'args': args or {},
+            'args': args,
             'filename': filename
         }
         
+        errors_before = self._include_error_count
+        expanded = self._expand_content(content, context)
+
+        self.current_path.pop()
+        self._current_path_set.discard(real_filename)
+
+        # python_eval output can differ between runs, and a body that
+        # embedded a cycle/recursion placeholder depends on the include path
+        # it was expanded under; only cache bodies whose expansion is a pure
+        # function of the file and its args.
+        if (cache_key is not None
+                and '[$python_eval' not in content
+                and self._include_error_count == errors_before):
+            self._expand_cache[cache_key] = expanded
+        return expanded
+
+    def _expand_content(self, content: str, context: Dict[str, Any]) -> str:
+        """Expand all directives in content in a single left-to-right pass.
+
+        Nested replacements are expanded via an explicit frame stack rather
+        than Python recursion, so deeply nested directives cost a list entry
+        instead of an interpreter frame.
+        """
+        if '[$' not in content:
+            return content
+
+        # Hoist per-iteration attribute lookups out of the loop
+        parse = self.parse_directive
+        directives_get = self.directives.get
+        literal_directives = self._LITERAL_DIRECTIVES
+
+        # Each frame is a segment being scanned: [text, resume offset,
+        # collected parts]. A finished frame joins its parts into the
+        # parent's part list.
+        stack: List[list] = [[content, 0, []]]
+
         while True:
-            directive_match = self.parse_directive(content)
+            frame = stack[-1]
+            text, pos, out_parts = frame
+
+            directive_match = parse(text, pos)
             if not directive_match:
-                break
-                
-            handler = self.directives.get(directive_match.directive_name)
+                out_parts.append(text[pos:])
+                finished = ''.join(out_parts)
+                stack.pop()
+                if not stack:
+                    return finished
+                stack[-1][2].append(finished)
+                continue
+
+            out_parts.append(text[pos:directive_match.start])
+            frame[1] = directive_match.end
+
+            handler = directives_get(directive_match.directive_name)
             if handler:
                 replacement = handler(directive_match.args, context)
+                # A replacement may itself contain directives (e.g. included
+                # content); push it as its own segment. Skip literal-output
+                # directives, and skip replacements that echo the original
+                # directive back, so error placeholders can't expand forever.
+                if (directive_match.directive_name not in literal_directives
+                        and '[$' in replacement
+                        and replacement != directive_match.full_match):
+                    stack.append([replacement, 0, []])
+                    continue
             else:
-                print(f"Warning: Unknown directive '{directive_match.directive_name}'")
+                log.warning("Unknown directive '%s'", directive_match.directive_name)
                 replacement = directive_match.full_match
-            
-            content = (
-                content[:directive_match.start] +
-                replacement +
-                content[directive_match.end:]
-            )
-        
-        self.current_path.pop()
-        return content
+
+            out_parts.append(replacement)
 
     def process_file(self, input_filename: str, output_filename: str, initial_args: Dict[str, str] = None):
         """Process the input file and write the result to the output file."""
         try:
             processed_content = self.process_file_recursive(input_filename, initial_args)
             
-            with open(output_filename, 'w') as file:
-                file.write(processed_content)
+            # Unbuffered binary mode writes the whole output in one syscall
+            with open(output_filename, 'wb', buffering=0) as file:
+                file.write(processed_content.encode('utf-8'))
             print(f"Successfully processed {input_filename} to {output_filename} in {len(processed_content)} characters")
             
         except Exception as e:
             print(f"Error processing file: {str(e)}")
-            # In case of error, copy input to output
-            with open(input_filename, 'r') as infile, open(output_filename, 'w') as outfile:
+            # In case of error, copy input to output byte-for-byte
+            with open(input_filename, 'rb') as infile, open(output_filename, 'wb') as outfile:
                 outfile.write(infile.read())
             print(f"Copied original file to {output_filename} due to error")
             
@@ -259,6 +424,8 @@ class FileProcessor:
 import argparse
 
 def main():
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
     parser = argparse.ArgumentParser(prog="bppcomp", description='Process b++ files with configurable arguments.')
     
     # Required arguments
@@ -266,7 +433,7 @@ def main():
     parser.add_argument('output_file', help='Output file path')
     
     # Optional argument for arbitrary key-value pairs
-    parser.add_argument('-D', '--define', action='append', nargs=2,
+    parser.add_argument('-D', '--define', action='append', nargs=2, default=[],
                       metavar=('KEY', 'VALUE'),
                       help='Define arbitrary top-level arguments as key-value pairs')
 
@@ -279,9 +446,7 @@ def main():
     }
 
     # Add user-defined arguments
-    if args.define:
-        for key, value in args.define:
-            initial_args[key] = value
+    initial_args.update((sys.intern(key), value) for key, value in args.define)
 
     print(initial_args)
     